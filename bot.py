@@ -1,6 +1,17 @@
+import asyncio
+import atexit
+import csv
+import functools
+import glob
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
 import subprocess
-from typing import Dict
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
 import psutil
 import yaml
@@ -8,20 +19,97 @@ from telegram import Bot
 from telegram import Update
 from telegram.ext import Application, CommandHandler, CallbackContext
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    # PyYAML built without libyaml
+    from yaml import SafeLoader
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+# callers only put records into log_queue, console and file are written
+# by the listener thread
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.StreamHandler(),  # Logs to console
+    logging.FileHandler('bot.log', mode='a', encoding='utf-8')
+]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler('bot.log', mode='a', encoding='utf-8')
-    ]
+    format='%(message)s',  # the listener's handlers add the rest
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 
+PROC_STAT = '/proc/stat'
+PROC_MEMINFO = '/proc/meminfo'
+HWMON_DIR = '/sys/class/hwmon'
+
+# busy and total CPU jiffies from the previous get_cpu_usage() call
+cpu_times = {"busy": 0, "total": 0}
+
+# resolved once, None if there is no nvidia-smi on this machine
+NVIDIA_SMI = shutil.which('nvidia-smi')
+GPU_STREAM_INTERVAL_MS = 1000
+GPU_QUERY_ARGV = (
+    NVIDIA_SMI,
+    '--query-gpu=index,temperature.gpu,memory.used,memory.total',
+    '--format=csv,noheader,nounits'
+)
+GPU_STREAM_ARGV = GPU_QUERY_ARGV + ('-lms', str(GPU_STREAM_INTERVAL_MS))
+# streamed rows older than this (seconds) are ignored, e.g. if the stream
+# died or a GPU started reporting [N/A]
+GPU_STREAM_MAX_AGE = 5
+# a one-shot nvidia-smi call or an NVML read taking longer (seconds) is
+# given up on
+GPU_QUERY_TIMEOUT = 2
+# after nvidia-smi fails, it is not called again for this many seconds
+GPU_FAILURE_BACKOFF = 3600
+gpu_disabled_until = 0.0
+
+# GPU index -> (time received, latest row), filled by the nvidia-smi stream
+# reader thread
+latest_gpu_state: Dict[int, Tuple[float, List[int]]] = {}
+latest_gpu_state_lock = threading.Lock()
+# GPU indices whose unparsable rows have already been reported
+unparsable_gpu_rows = set()
+
+# last collected get_state() result, reused for "ttl" seconds
+state_cache = {"ts": 0.0, "data": None, "ttl": 0.0}
+state_cache_lock = asyncio.Lock()
+
+# held while a monitor() tick runs, so that a slow tick is not overlapped
+monitor_lock = asyncio.Lock()
+
+# threshold name, alert label and unit, in the order of get_state() values
+ALERT_SCHEMA = (
+    ('cpu_usage', 'CPU usage', '%'),
+    ('cpu_temperature', 'CPU temperature', '°C'),
+    ('gpu_temperature', 'GPU temperature', '°C'),
+    ('memory_usage', 'memory usage', '%'),
+    ('gpu_memory_usage', 'GPU memory usage', '%'),
+)
+
+# NVML device handles, fetched once in init_nvml()
+nvml_handles: List = []
+# NVML read running in a worker thread; a read stuck in the driver is
+# waited on again instead of starting another thread
+nvml_read = {"future": None}
+
 
 def load_config(path: str = "config.yaml"):
     with open(path, "r", encoding="utf-8") as stream:
         try:
-            config = yaml.safe_load(stream)
+            config = yaml.load(stream, Loader=SafeLoader)
             logging.info("Config loaded successfully.")
             return config
         except yaml.YAMLError:
@@ -33,124 +121,332 @@ def load_config(path: str = "config.yaml"):
 
 
 def get_cpu_usage():
-    return psutil.cpu_percent(interval=1)
+    # non-blocking: usage since the previous call, see main() for the first one
+    try:
+        with open(PROC_STAT, "rb") as stat_file:
+            # user nice system idle iowait irq softirq steal, guest time is
+            # already included in user and nice
+            jiffies = [int(field) for field in stat_file.readline().split()[1:9]]
+    except (OSError, ValueError):
+        return psutil.cpu_percent(interval=None)
+    total = sum(jiffies)
+    busy = total - jiffies[3] - jiffies[4]
+    busy_delta = busy - cpu_times["busy"]
+    total_delta = total - cpu_times["total"]
+    cpu_times["busy"] = busy
+    cpu_times["total"] = total
+    if total_delta <= 0:
+        return 0.0
+    return round(busy_delta / total_delta * 100, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def find_coretemp_input():
+    for name_path in sorted(glob.glob(os.path.join(HWMON_DIR, 'hwmon*', 'name'))):
+        try:
+            with open(name_path, "r", encoding="utf-8") as name_file:
+                name = name_file.read().strip()
+        except OSError:
+            continue
+        if name == 'coretemp':
+            return os.path.join(os.path.dirname(name_path), 'temp1_input')
+    return None
 
 
 def get_cpu_temperature():
+    path = find_coretemp_input()
+    if path is not None:
+        try:
+            with open(path, "r", encoding="utf-8") as temp_file:
+                return int(temp_file.read()) / 1000.0
+        except (OSError, ValueError):
+            logging.exception("Could not read %s, looking for coretemp again", path)
+            find_coretemp_input.cache_clear()
+
     temps = psutil.sensors_temperatures()
     if 'coretemp' in temps:
         return temps['coretemp'][0].current
     else:
-        logging.warning(f"No CPU temperatures found in {temps}")
+        logging.warning("No CPU temperatures found in %s", temps)
         return None
 
 
-def get_gpu_temperature():
+def init_nvml() -> bool:
+    if pynvml is None:
+        logging.info("pynvml is not installed, falling back to nvidia-smi.")
+        return False
     try:
-        result = subprocess.run(
-            [
-                'nvidia-smi',
-                '--query-gpu=temperature.gpu',
-                '--format=csv,noheader,nounits'],
-            stdout=subprocess.PIPE
-        )
-        temperatures = (result.stdout.decode('utf-8')
-                        .strip()
-                        .replace("\n", " ")
-                        .replace("  ", " ")
-                        .split(" "))
-        return max([int(temp) for temp in temperatures])
+        pynvml.nvmlInit()
+    except Exception:
+        logging.exception("Could not initialize NVML, falling back to nvidia-smi")
+        return False
+    try:
+        handles = [pynvml.nvmlDeviceGetHandleByIndex(i)
+                   for i in range(pynvml.nvmlDeviceGetCount())]
     except Exception:
-        logging.exception("Could not obtain GPU temperature")
+        logging.exception("Could not get NVML device handles, falling back to nvidia-smi")
+        handles = []
+    else:
+        if not handles:
+            logging.info("NVML found no GPUs, falling back to nvidia-smi.")
+    if not handles:
+        try:
+            pynvml.nvmlShutdown()
+        except Exception:
+            logging.exception("Could not shut NVML down")
+        return False
+    nvml_handles[:] = handles
+    atexit.register(pynvml.nvmlShutdown)
+    logging.info("NVML initialized, GPUs found: %d", len(nvml_handles))
+    return True
+
+
+def nvml_gpu_state():
+    try:
+        temperatures = [
+            pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
+            for handle in nvml_handles
+        ]
+        memory = [pynvml.nvmlDeviceGetMemoryInfo(handle) for handle in nvml_handles]
+        used_memory = sum(info.used for info in memory)
+        total_memory = sum(info.total for info in memory)
+        return max(temperatures), (used_memory / total_memory) * 100
+    except Exception:
+        logging.exception("Could not obtain GPU state via NVML")
+        return None, None
+
+
+async def read_nvml_gpu_state():
+    future = nvml_read["future"]
+    if future is None or future.done():
+        future = asyncio.ensure_future(asyncio.to_thread(nvml_gpu_state))
+        nvml_read["future"] = future
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), GPU_QUERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("NVML did not answer in %d s", GPU_QUERY_TIMEOUT)
+        return None, None
+
+
+def parse_gpu_row(fields: List[str]) -> List[int]:
+    # raises ValueError unless there are exactly four integer fields
+    index, temp, used_memory, total_memory = (int(field) for field in fields)
+    return [index, temp, used_memory, total_memory]
+
+
+def gpu_state_from_rows(rows: List[List[int]]):
+    # hottest GPU and VRAM usage over all GPUs, None if no GPU reported
+    if not rows:
+        return None, None
+    gpu_temp = max(temp for _, temp, _, _ in rows)
+    used_memory = sum(used for _, _, used, _ in rows)
+    total_memory = sum(total for _, _, _, total in rows)
+    if total_memory == 0:
+        # VRAM size not reported, the temperature is still usable
+        return gpu_temp, None
+    gpu_memory_usage = (used_memory / total_memory) * 100
+    return gpu_temp, gpu_memory_usage
+
+
+def read_gpu_row(fields: List[str]) -> Optional[List[int]]:
+    # None for rows that cannot be used, e.g. a GPU reporting [N/A]
+    if not fields:
+        return None
+    try:
+        return parse_gpu_row(fields)
+    except ValueError:
+        gpu = fields[0].strip()
+        if gpu not in unparsable_gpu_rows:
+            unparsable_gpu_rows.add(gpu)
+            logging.warning("Unexpected nvidia-smi output for GPU %s: %r; "
+                            "such rows are skipped", gpu, fields)
         return None
 
 
-def get_memory_usage() -> float:
-    memory = psutil.virtual_memory()
-    return memory.percent
+def disable_gpu_polling(reason: str):
+    global gpu_disabled_until
+    gpu_disabled_until = time.monotonic() + GPU_FAILURE_BACKOFF
+    logging.warning("%s; GPU polling disabled for %d s.", reason, GPU_FAILURE_BACKOFF)
+
 
+def drain_gpu_stream(process: subprocess.Popen):
+    for fields in csv.reader(process.stdout):
+        row = read_gpu_row(fields)
+        if row is None:
+            continue
+        with latest_gpu_state_lock:
+            latest_gpu_state[row[0]] = (time.monotonic(), row)
+    logging.warning("nvidia-smi stream exited with code %s", process.wait())
 
-def get_gpu_memory_usage() -> float:
+
+def start_gpu_stream():
+    if NVIDIA_SMI is None:
+        logging.info("nvidia-smi not found, GPU readings are unavailable.")
+        return None
     try:
-        # todo: multigpu setup
-        result = subprocess.run(
-            [
-                'nvidia-smi',
-                '--query-gpu=memory.used,memory.total',
-                '--format=csv,noheader,nounits'
-            ],
-            stdout=subprocess.PIPE
+        process = subprocess.Popen(
+            GPU_STREAM_ARGV,
+            stdout=subprocess.PIPE,
+            bufsize=1,
+            text=True
         )
-        output = result.stdout.decode('utf-8').strip().split(',')
-        used_memory = int(output[0].strip())
-        total_memory = int(output[1].strip())
-        gpu_memory_usage = (used_memory / total_memory) * 100
-        return gpu_memory_usage
+    except FileNotFoundError:
+        disable_gpu_polling("nvidia-smi not found")
+        return None
     except Exception:
+        logging.exception("Could not start nvidia-smi stream")
         return None
+    atexit.register(process.terminate)
+    threading.Thread(target=drain_gpu_stream, args=(process,),
+                     name="nvidia-smi-stream", daemon=True).start()
+    logging.info("nvidia-smi stream started.")
+    return process
+
+
+async def query_gpu_state():
+    if NVIDIA_SMI is None or time.monotonic() < gpu_disabled_until:
+        return None, None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *GPU_QUERY_ARGV, stdout=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), GPU_QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            disable_gpu_polling(f"nvidia-smi did not answer in {GPU_QUERY_TIMEOUT} s")
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            # a child stuck in the driver may ignore SIGKILL, so the reap is
+            # bounded too and the zombie is left to the child watcher
+            try:
+                await asyncio.wait_for(process.wait(), GPU_QUERY_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning("nvidia-smi (pid %s) is still running after kill, "
+                                "not waiting for it", process.pid)
+            return None, None
+        if process.returncode != 0:
+            disable_gpu_polling(f"nvidia-smi exited with code {process.returncode}")
+            return None, None
+        rows = [read_gpu_row(fields)
+                for fields in csv.reader(stdout.decode('utf-8').splitlines())]
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            disable_gpu_polling("nvidia-smi reported no usable GPU readings")
+            return None, None
+        return gpu_state_from_rows(rows)
+    except FileNotFoundError:
+        disable_gpu_polling("nvidia-smi not found")
+        return None, None
+    except Exception:
+        logging.exception("Could not obtain GPU state")
+        return None, None
+
+
+async def get_gpu_state():
+    if nvml_handles:
+        return await read_nvml_gpu_state()
+    now = time.monotonic()
+    with latest_gpu_state_lock:
+        # a GPU that stopped reporting usable rows drops out after a while
+        rows = [row for received, row in latest_gpu_state.values()
+                if now - received < GPU_STREAM_MAX_AGE]
+    if rows:
+        return gpu_state_from_rows(rows)
+    # no fresh streamed sample, asking nvidia-smi directly
+    return await query_gpu_state()
+
+
+def get_memory_usage() -> float:
+    try:
+        with open(PROC_MEMINFO, "rb") as meminfo_file:
+            # MemTotal and MemAvailable are among the first lines
+            lines = meminfo_file.read().split(b'\n')[:5]
+        meminfo = {}
+        for line in lines:
+            key, _, value = line.partition(b':')
+            meminfo[key] = int(value.split()[0]) if value else 0
+        total_memory = meminfo[b'MemTotal']
+        available_memory = meminfo[b'MemAvailable']
+    except (OSError, KeyError, ValueError, IndexError):
+        return psutil.virtual_memory().percent
+    return round((total_memory - available_memory) / total_memory * 100, 1)
 
 
 async def send_alert(message: str, bot: Bot, chat_id):
     try:
         await bot.send_message(chat_id=chat_id, text=message)
     except Exception as e:
-        logging.error(f"Error sending message: {e}")
+        logging.error("Error sending message: %s", e)
 
 
-def get_state():
-    cpu_usage = get_cpu_usage()
-    cpu_temp = get_cpu_temperature()
-    gpu_temp = get_gpu_temperature()
-    memory_usage = get_memory_usage()
-    gpu_memory_usage = get_gpu_memory_usage()
+def collect_host_state():
+    return get_cpu_usage(), get_cpu_temperature(), get_memory_usage()
+
+
+async def collect_state():
+    # host sensors are read in a worker thread while the GPU is read
+    (cpu_usage, cpu_temp, memory_usage), (gpu_temp, gpu_memory_usage) = \
+        await asyncio.gather(asyncio.to_thread(collect_host_state), get_gpu_state())
     return cpu_usage, cpu_temp, gpu_temp, memory_usage, gpu_memory_usage
 
 
+async def get_state():
+    async with state_cache_lock:
+        if (state_cache["data"] is not None
+                and time.monotonic() - state_cache["ts"] < state_cache["ttl"]):
+            return state_cache["data"]
+        state = await collect_state()
+        state_cache["data"] = state
+        state_cache["ts"] = time.monotonic()
+        return state
+
+
+def build_alert_rules(thresholds: Dict) -> Tuple:
+    return tuple((thresholds[name], f"High {label} detected: {{}}{unit}")
+                 for name, label, unit in ALERT_SCHEMA)
+
+
 async def status(update: Update, context: CallbackContext):
-    cpu_usage, cpu_temp, gpu_temp, memory_usage, gpu_memory_usage = get_state()
-    status_message = (
-            f"CPU Usage: {cpu_usage}%\n" +
-            (f"CPU Temperature: {cpu_temp}°C\n"
-             if cpu_temp is not None
-             else "CPU Temperature: Not available\n") +
-            (f"GPU Temperature: {gpu_temp}°C\n"
-             if gpu_temp is not None
-             else "GPU Temperature: Not available\n") +
-            f"RAM Usage: {memory_usage}%\n" +
-            (f"VRAM Usage: {gpu_memory_usage}%"
-             if gpu_memory_usage is not None else "VRAM Usage: Not available")
-    )
+    cpu_usage, cpu_temp, gpu_temp, memory_usage, gpu_memory_usage = await get_state()
+    lines = [f"CPU Usage: {cpu_usage}%"]
+    lines.append(f"CPU Temperature: {cpu_temp}°C"
+                 if cpu_temp is not None
+                 else "CPU Temperature: Not available")
+    lines.append(f"GPU Temperature: {gpu_temp}°C"
+                 if gpu_temp is not None
+                 else "GPU Temperature: Not available")
+    lines.append(f"RAM Usage: {memory_usage}%")
+    lines.append(f"VRAM Usage: {gpu_memory_usage}%"
+                 if gpu_memory_usage is not None
+                 else "VRAM Usage: Not available")
+    status_message = "\n".join(lines)
 
     await update.message.reply_text(status_message)
-    logging.info(f"Status requested by {update.message.from_user.username} "
-                 f"({update.message.from_user.id})")
+    logging.info("Status requested by %s (%s)",
+                 update.message.from_user.username, update.message.from_user.id)
 
 
 async def monitor(context: CallbackContext):
-    logging.debug("Getting the numbers...")
-    numbers = get_state()
-    logging.info(f"Current machine state numbers: {numbers}")
-    cpu_usage, cpu_temp, gpu_temp, memory_usage, gpu_memory_usage = numbers
-    thresholds: Dict = context.job.data
-    logging.debug("Numbers obtained...")
-
-    alert_message = ""
-
-    # Check thresholds and create alerts
-    if cpu_usage > thresholds['cpu_usage']:
-        alert_message += f"High CPU usage detected: {cpu_usage}%\n"
-    if cpu_temp and cpu_temp > thresholds['cpu_temperature']:
-        alert_message += f"High CPU temperature detected: {cpu_temp}°C\n"
-    if gpu_temp and gpu_temp > thresholds['gpu_temperature']:
-        alert_message += f"High GPU temperature detected: {gpu_temp}°C\n"
-    if memory_usage > thresholds['memory_usage']:
-        alert_message += f"High memory usage detected: {memory_usage}%\n"
-    if gpu_memory_usage and gpu_memory_usage > thresholds["gpu_memory_usage"]:
-        alert_message += f"High GPU memory usage detected: {gpu_memory_usage}%"
-
-    if alert_message:
-        logging.info("Alert! " + alert_message.replace("\n", " >> "))
-        await send_alert(alert_message, context.bot, context.job.chat_id)
+    if monitor_lock.locked():
+        logging.warning("Previous monitoring tick is still running, skipping this one.")
+        return
+    async with monitor_lock:
+        logging.debug("Getting the numbers...")
+        numbers = await get_state()
+        logging.info("Current machine state numbers: %s", numbers)
+        rules: Tuple = context.job.data
+        logging.debug("Numbers obtained...")
+
+        # Check thresholds and create alerts
+        alert_message = "\n".join(template.format(value)
+                                  for value, (threshold, template) in zip(numbers, rules)
+                                  if value is not None and value > threshold)
+
+        if alert_message:
+            logging.info("Alert! %s", alert_message.replace("\n", " >> "))
+            await send_alert(alert_message, context.bot, context.job.chat_id)
 
 
 def main():
@@ -159,13 +455,24 @@ def main():
     application.add_handler(CommandHandler("status", status))
     logging.info("Handlers added.")
 
+    if not init_nvml():
+        start_gpu_stream()
+
+    # sets the CPU usage baseline (the first non-blocking get_cpu_usage() call
+    # has nothing to compare with) and looks up the coretemp sensor, so that
+    # the first /status or monitor tick does not pay for it
+    collect_host_state()
+
+    state_cache["ttl"] = config.get("cache-ttl", config["polling-frequency"] / 2)
+    logging.info("Readings are cached for %s s.", state_cache["ttl"])
+
     thresholds = config["thresholds"]
-    logging.info(f"Thresholds: {thresholds}")
+    logging.info("Thresholds: %s", thresholds)
 
     application.job_queue.run_repeating(monitor,
                                         interval=config["polling-frequency"],
                                         chat_id=config["chat-id"],
-                                        data=thresholds)
+                                        data=build_alert_rules(thresholds))
     application.run_polling()
 
 